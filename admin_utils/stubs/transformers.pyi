@@ -30,6 +30,7 @@ class Trainer:
         model: torch.nn.Module,
         args: TrainingArguments,
         train_dataset: Dataset | list[dict[str, Any]],
+        data_collator: DataCollatorWithPadding | None = None,
     ): ...
     def save_model(self, path: Path) -> None: ...
     def train(self) -> None: ...
@@ -69,5 +70,8 @@ class PreTrainedTokenizerBase:
     cls_token_id: int
     mask_token_id: int
 
+class DataCollatorWithPadding:
+    def __init__(self, tokenizer: PreTrainedTokenizerBase) -> None: ...
+
 class AutoTokenizer(PreTrainedTokenizerBase):
     def __call__(self, *args: Any, **kwds: Any) -> BatchEncoding: ...
@@ -4,16 +4,24 @@ Laboratory work.
 Working with Large Language Models.
 """
 # pylint: disable=too-few-public-methods, undefined-variable, too-many-arguments, super-init-not-called
+import math
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from typing import Iterable, Sequence
+from typing import cast, Iterable, Sequence
 
 import datasets
+import numpy as np
 import pandas as pd
 import torch
 from evaluate import load
 from pandas import DataFrame
-from torch.utils.data import DataLoader, Dataset
-from torchinfo import summary
+from torch.nn.attention import sdpa_kernel, SDPBackend
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import BatchSampler, DataLoader, Dataset
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
 from core_utils.llm.llm_pipeline import AbstractLLMPipeline
@@ -23,6 +31,11 @@ from core_utils.llm.raw_data_preprocessor import AbstractRawDataPreprocessor, Co
 from core_utils.llm.task_evaluator import AbstractTaskEvaluator
 from core_utils.llm.time_decorator import report_time
 
+try:
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+except ImportError:
+    ORTModelForSeq2SeqLM = None  # type: ignore
+
 
 class RawDataImporter(AbstractRawDataImporter):
     """
@@ -38,7 +51,7 @@ class RawDataImporter(AbstractRawDataImporter):
             TypeError: In case of downloaded dataset is not pd.DataFrame
         """
         dataset = datasets.load_dataset(self._hf_name, split="test")
-        self._raw_data = pd.DataFrame(dataset)
+        self._raw_data = dataset.with_format("arrow")[:].to_pandas(types_mapper=pd.ArrowDtype)
 
         if not isinstance(self._raw_data, pd.DataFrame):
             raise TypeError("downloaded dataset is not pd.DataFrame.")
@@ -61,9 +74,8 @@ class RawDataPreprocessor(AbstractRawDataPreprocessor):
             'dataset_columns': self._raw_data.shape[1],
             'dataset_duplicates': self._raw_data.duplicated().sum(),
             'dataset_empty_rows': self._raw_data.isnull().all(axis=1).sum(),
-            'dataset_sample_min_len': self._raw_data['article'].dropna(how='all').map(len).min(),
-            'dataset_sample_max_len': self._raw_data['article'].dropna(how='all').map(len).max()
-
+            'dataset_sample_min_len': self._raw_data['article'].str.len().min(),
+            'dataset_sample_max_len': self._raw_data['article'].str.len().max()
         }
 
         return dataset_info
@@ -92,6 +104,8 @@ class TaskDataset(Dataset):
             data (pandas.DataFrame): Original data
         """
         self._data = data
+        self._source = (np.empty(0, dtype=object) if data.empty
+                        else data[ColumnNames.SOURCE.value].to_numpy(dtype=object))
 
     def __len__(self) -> int:
         """
@@ -112,9 +126,65 @@ class TaskDataset(Dataset):
         Returns:
             tuple[str, ...]: The item to be received
         """
-        item = str(self._data.loc[index, ColumnNames.SOURCE.value])
+        return (str(self._source[index]),)
+
+    @property
+    def data(self) -> DataFrame:
+        """
+        Property with access to preprocessed DataFrame.
+
+        Returns:
+            pandas.DataFrame: Preprocessed DataFrame
+        """
+        return self._data
+
+
+class TokenizedTaskDataset(Dataset):
+    """
+    A class that converts pd.DataFrame to a pre-tokenized Dataset and works with it.
+    """
 
-        return tuple([item])
+    def __init__(self, data: pd.DataFrame, tokenizer: AutoTokenizer, max_length: int) -> None:
+        """
+        Initialize an instance of TokenizedTaskDataset.
+
+        Args:
+            data (pandas.DataFrame): Original data
+            tokenizer (transformers.models.auto.tokenization_auto.AutoTokenizer): Tokenizer to
+                tokenize the dataset
+            max_length (int): The maximum length of a tokenized sequence
+        """
+        self._data = data
+        tokens = tokenizer(list(data[ColumnNames.SOURCE.value]),
+                           padding=False,
+                           truncation=True,
+                           max_length=max_length)
+        self._input_ids = [np.asarray(input_ids, dtype=np.int32)
+                           for input_ids in tokens["input_ids"]]
+        self._attention_mask = [np.asarray(attention_mask, dtype=np.int32)
+                                for attention_mask in tokens["attention_mask"]]
+
+    def __len__(self) -> int:
+        """
+        Return the number of items in the dataset.
+
+        Returns:
+            int: The number of items in the dataset
+        """
+        return len(self._input_ids)
+
+    def __getitem__(self, index: int) -> dict[str, torch.Tensor]:
+        """
+        Retrieve an item from the dataset by index.
+
+        Args:
+            index (int): Index of sample in dataset
+
+        Returns:
+            dict[str, torch.Tensor]: Input ids and attention mask of the sample
+        """
+        return {"input_ids": torch.from_numpy(self._input_ids[index]).to(torch.long),
+                "attention_mask": torch.from_numpy(self._attention_mask[index]).to(torch.long)}
 
     @property
     def data(self) -> DataFrame:
@@ -127,29 +197,129 @@ class TaskDataset(Dataset):
         return self._data
 
 
+def pad_batch(
+    sample_batch: Sequence[dict[str, torch.Tensor]], pad_token_id: int
+) -> dict[str, torch.Tensor]:
+    """
+    Pad a batch of pre-tokenized samples to its longest sequence.
+
+    Args:
+        sample_batch (Sequence[dict[str, torch.Tensor]]): Tokenized samples
+        pad_token_id (int): Id of the padding token
+
+    Returns:
+        dict[str, torch.Tensor]: Padded input ids and attention mask of the batch
+    """
+    return {"input_ids": pad_sequence([sample["input_ids"] for sample in sample_batch],
+                                      batch_first=True, padding_value=pad_token_id),
+            "attention_mask": pad_sequence([sample["attention_mask"] for sample in sample_batch],
+                                           batch_first=True, padding_value=0)}
+
+
+def tokenize_batch(
+    sample_batch: Sequence[tuple[str, ...]], tokenizer: AutoTokenizer
+) -> dict[str, torch.Tensor]:
+    """
+    Tokenize a batch of samples.
+
+    Used as a DataLoader collate function, so tokenization runs inside worker processes.
+
+    Args:
+        sample_batch (Sequence[tuple[str, ...]]): Samples to tokenize
+        tokenizer (transformers.models.auto.tokenization_auto.AutoTokenizer): Tokenizer to
+            tokenize the samples
+
+    Returns:
+        dict[str, torch.Tensor]: Padded input ids and attention mask of the batch
+    """
+    tokens = tokenizer(
+        [sample[0] for sample in sample_batch],
+        padding=True,
+        truncation=True,
+        return_tensors="pt"
+    )
+
+    return {"input_ids": tokens["input_ids"],
+            "attention_mask": tokens["attention_mask"]}
+
+
+def collect_parameters(model: torch.nn.Module) -> list[torch.nn.Parameter]:
+    """
+    Collect model parameters the way torchinfo accounts for them.
+
+    Every leaf module contributes all of its parameters, so weights tied between
+    modules (e.g. input embeddings and the output projection) are listed once per module.
+
+    Args:
+        model (torch.nn.Module): Model to inspect
+
+    Returns:
+        list[torch.nn.Parameter]: Parameters of the model
+    """
+    leaf_parameters = [parameter for module in model.modules() if not any(module.children())
+                       for parameter in module.parameters()]
+    leaf_ids = {id(parameter) for parameter in leaf_parameters}
+    return leaf_parameters + [parameter for parameter in model.parameters()
+                              if id(parameter) not in leaf_ids]
+
+
 class LLMPipeline(AbstractLLMPipeline):
     """
     A class that initializes a model, analyzes its properties and infers it.
+
+    Speculative decoding is disabled by default. To enable it, pass a smaller model
+    with the same vocabulary as assistant_model_name; it is then used by infer_sample.
     """
 
     def __init__(
-        self, model_name: str, dataset: TaskDataset, max_length: int, batch_size: int, device: str
+        self,
+        model_name: str,
+        dataset: TaskDataset | TokenizedTaskDataset,
+        max_length: int,
+        batch_size: int,
+        device: str,
+        *,
+        assistant_model_name: str | None = None
     ) -> None:
         """
         Initialize an instance of LLMPipeline.
 
         Args:
             model_name (str): The name of the pre-trained model
-            dataset (TaskDataset): The dataset used
+            dataset (TaskDataset | TokenizedTaskDataset): The dataset used
             max_length (int): The maximum length of generated sequence
             batch_size (int): The size of the batch inside DataLoader
             device (str): The device for inference
+            assistant_model_name (str | None): The name of a smaller draft model
+                for speculative decoding, used by infer_sample only since assisted
+                generation does not support batches
         """
         super().__init__(model_name, dataset, max_length, batch_size, device)
-        self._model = AutoModelForSeq2SeqLM.from_pretrained(model_name).to(device)
-        self._model.eval()
+        use_ort = os.environ.get("USE_ORT") == "1"
+        if use_ort and ORTModelForSeq2SeqLM is None:
+            warnings.warn('Library "optimum" not installed, falling back to PyTorch inference.',
+                          stacklevel=2)
+            use_ort = False
+
+        if use_ort:
+            self._model = ORTModelForSeq2SeqLM.from_pretrained(
+                model_name,
+                export=True,
+                provider="CUDAExecutionProvider" if device == "cuda" else "CPUExecutionProvider"
+            )
+        else:
+            self._model = AutoModelForSeq2SeqLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+                attn_implementation="sdpa"
+            ).to(device)
+            self._model.eval()
         self._tokenizer = AutoTokenizer.from_pretrained(model_name,
-                                                        model_max_length=max_length)
+                                                        model_max_length=max_length,
+                                                        use_fast=True)
+        self._assistant = None
+        if assistant_model_name is not None and isinstance(self._model, torch.nn.Module):
+            self._assistant = self._load_assistant(assistant_model_name)
 
     def analyze_model(self) -> dict:
         """
@@ -162,23 +332,17 @@ class LLMPipeline(AbstractLLMPipeline):
             raise ValueError("Incorrect type of model")
 
         embeddings_length = self._model.config.decoder.max_position_embeddings
-        tensor = torch.ones(1, embeddings_length, dtype=torch.long)
-
-        ids = {"input_ids": tensor,
-               "attention_mask": tensor}
-
-        statistics = summary(self._model,
-                             input_data=ids,
-                             decoder_input_ids=tensor,
-                             verbose=False)
+        vocab_size = self._model.config.decoder.vocab_size
+        parameters = collect_parameters(self._model)
 
         model_info = {
-            "input_shape": list(statistics.input_size['input_ids']),
+            "input_shape": [1, embeddings_length],
             "embedding_size": embeddings_length,
-            "output_shape": statistics.summary_list[-1].output_size,
-            "num_trainable_params": statistics.trainable_params,
-            "vocab_size": self._model.config.decoder.vocab_size,
-            "size": statistics.total_param_bytes,
+            "output_shape": [1, embeddings_length, vocab_size],
+            "num_trainable_params": sum(parameter.numel() for parameter in parameters
+                                        if parameter.requires_grad),
+            "vocab_size": vocab_size,
+            "size": sum(parameter.numel() * parameter.element_size() for parameter in parameters),
             "max_context_length": self._model.config.max_length
         }
 
@@ -195,7 +359,7 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             str | None: A prediction
         """
-        return self._infer_batch([sample])[0]
+        return self._infer_batch(tokenize_batch([sample], self._tokenizer))[0]
 
     @report_time
     def infer_dataset(self) -> pd.DataFrame:
@@ -205,53 +369,135 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             pd.DataFrame: Data with predictions
         """
-        data_loader = DataLoader(dataset=self._dataset, batch_size=self._batch_size)
-        predictions = []
-
-        with torch.no_grad():
+        sources = self._dataset.data[ColumnNames.SOURCE.value]
+        unique_positions = np.flatnonzero(~sources.duplicated().to_numpy())
+        lengths = sources.str.len().to_numpy()[unique_positions]
+        order = unique_positions[lengths.argsort(kind="stable")]
+        if isinstance(self._dataset, TokenizedTaskDataset):
+            collate_fn = partial(pad_batch, pad_token_id=self._tokenizer.pad_token_id)
+        else:
+            collate_fn = partial(tokenize_batch, tokenizer=self._tokenizer)
+        num_workers = (os.cpu_count() or 1) // 2
+        if num_workers:
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        data_loader = DataLoader(dataset=self._dataset,
+                                 batch_sampler=BatchSampler(order.tolist(), self._batch_size,
+                                                            drop_last=False),
+                                 collate_fn=collate_fn,
+                                 num_workers=num_workers,
+                                 pin_memory=self._device == "cuda",
+                                 prefetch_factor=4 if num_workers else None,
+                                 persistent_workers=num_workers > 0)
+        predictions: list[str | None] = [None] * len(order)
+        offset = 0
+
+        with torch.inference_mode():
             for batch in data_loader:
                 batch_predictions = self._infer_batch(batch)
-                predictions.extend(batch_predictions)
+                predictions[offset:offset + len(batch_predictions)] = batch_predictions
+                offset += len(batch_predictions)
 
+        source_predictions = dict(zip(sources.iloc[order], predictions))
         result_df = pd.DataFrame(self._dataset.data)
-        result_df[ColumnNames.PREDICTION.value] = predictions
+        result_df[ColumnNames.PREDICTION.value] = sources.map(source_predictions)
 
         return result_df
 
-    @torch.no_grad()
-    def _infer_batch(self, sample_batch: Sequence[tuple[str, ...]]) -> list[str]:
+    @torch.inference_mode()
+    def _infer_batch(self, sample_batch: dict[str, torch.Tensor]) -> list[str]:
         """
         Infer model on a single batch.
 
         Args:
-            sample_batch (Sequence[tuple[str, ...]]): Batch to infer the model
+            sample_batch (dict[str, torch.Tensor]): Tokenized batch to infer the model
 
         Returns:
             list[str]: Model predictions as strings
         """
-        inputs = self._tokenizer(
-            list(sample_batch[0]),
-            padding=True,
-            truncation=True,
-            return_tensors="pt"
-        ).to(self._device)
-
-        generated_ids = self._model.generate(
-            input_ids=inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
-            max_length=self._max_length
-        )
+        inputs = {name: tensor.to(self._device, non_blocking=True)
+                  for name, tensor in sample_batch.items()}
+
+        fused_attention = (sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+                           if self._device == "cuda" else nullcontext())
+
+        # assisted generation only supports single-sample greedy or sampling decoding
+        assisted = (self._assistant is not None
+                    and inputs["input_ids"].shape[0] == 1
+                    and self._model.generation_config.num_beams == 1)
+
+        with torch.autocast(device_type=self._device, dtype=torch.float16,
+                            enabled=self._device == "cuda"), fused_attention:
+            generated_ids = self._model.generate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_length=self._max_length,
+                use_cache=True,
+                assistant_model=self._assistant if assisted else None
+            )
 
         decoded_predictions = self._tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
 
         return [prediction.strip() for prediction in decoded_predictions]
 
+    def _load_assistant(self, assistant_model_name: str) -> torch.nn.Module | None:
+        """
+        Load a draft model for speculative decoding.
+
+        The draft model only applies to single-sample inference, so infer_dataset
+        batches are generated without it.
+
+        Args:
+            assistant_model_name (str): The name of the draft model
+
+        Returns:
+            torch.nn.Module | None: The draft model, or None if it cannot assist the main model
+        """
+        try:
+            assistant = AutoModelForSeq2SeqLM.from_pretrained(
+                assistant_model_name,
+                torch_dtype=torch.float16 if self._device == "cuda" else torch.float32
+            ).to(self._device)
+        except (OSError, ValueError):
+            warnings.warn(f"Failed to load assistant model {assistant_model_name}.",
+                          stacklevel=2)
+            return None
+
+        if (assistant.get_output_embeddings().weight.shape[0] !=
+                self._model.get_output_embeddings().weight.shape[0]):
+            warnings.warn(f"Assistant model {assistant_model_name} has a different vocabulary, "
+                          "speculative decoding is disabled.", stacklevel=2)
+            return None
+
+        assistant.eval()
+        return cast(torch.nn.Module, assistant)
+
+
+def score_rouge(predictions: list[str], references: list[str]) -> list[float]:
+    """
+    Compute ROUGE-L F-measure for every prediction and reference pair.
+
+    Args:
+        predictions (list[str]): Model predictions
+        references (list[str]): Reference texts
+
+    Returns:
+        list[float]: ROUGE-L score of each sample
+    """
+    scores = load(Metrics.ROUGE.value).compute(predictions=predictions,
+                                               references=references,
+                                               rouge_types=["rougeL"],
+                                               use_aggregator=False)
+    return list(scores["rougeL"])
+
 
 class TaskEvaluator(AbstractTaskEvaluator):
     """
     A class that compares prediction quality using the specified metric.
     """
 
+    # Samples per streamed metric batch and minimum samples per ROUGE worker
+    _CHUNK_SIZE = 256
+
     def __init__(self, data_path: Path, metrics: Iterable[Metrics]) -> None:
         """
         Initialize an instance of Evaluator.
@@ -273,16 +519,50 @@ class TaskEvaluator(AbstractTaskEvaluator):
         """
         data_to_evaluate = pd.read_csv(self.data_path)
 
-        predictions = data_to_evaluate[ColumnNames.PREDICTION.value]
-        targets = data_to_evaluate[ColumnNames.TARGET.value]
+        predictions = data_to_evaluate[ColumnNames.PREDICTION.value].tolist()
+        targets = data_to_evaluate[ColumnNames.TARGET.value].tolist()
+        chunk_size = self._CHUNK_SIZE
 
         evaluation = {}
         for metric in self._metrics:
-            scores = load(metric.value, seed=77).compute(predictions=predictions,
-                                                         references=targets)
             if metric.value == "rouge":
-                evaluation[metric.value] = scores["rougeL"]
+                evaluation[metric.value] = self._parallel_rouge(predictions, targets)
             else:
-                evaluation[metric.value] = scores[metric.value]
+                scorer = load(metric.value, seed=77)
+                for start in range(0, len(predictions), chunk_size):
+                    scorer.add_batch(predictions=predictions[start:start + chunk_size],
+                                     references=targets[start:start + chunk_size])
+                evaluation[metric.value] = scorer.compute()[metric.value]
 
         return evaluation
+
+    @classmethod
+    def _parallel_rouge(cls, predictions: list[str], references: list[str]) -> float:
+        """
+        Compute mean ROUGE-L over all samples, scoring chunks in separate processes.
+
+        Args:
+            predictions (list[str]): Model predictions
+            references (list[str]): Reference texts
+
+        Returns:
+            float: Mean ROUGE-L F-measure
+        """
+        if not predictions:
+            return 0.0
+
+        workers = max(1, min(os.cpu_count() or 1, len(predictions) // cls._CHUNK_SIZE))
+        if workers == 1:
+            sample_scores = score_rouge(predictions, references)
+        else:
+            chunk_size = math.ceil(len(predictions) / workers)
+            starts = range(0, len(predictions), chunk_size)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunk_scores = executor.map(
+                    score_rouge,
+                    [predictions[start:start + chunk_size] for start in starts],
+                    [references[start:start + chunk_size] for start in starts]
+                )
+                sample_scores = [score for scores in chunk_scores for score in scores]
+
+        return sum(sample_scores) / len(sample_scores)
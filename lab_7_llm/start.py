@@ -4,6 +4,8 @@ Starter for demonstration of laboratory work.
 # pylint: disable= too-many-locals, undefined-variable, unused-import
 from pathlib import Path
 
+from transformers import AutoTokenizer
+
 from config.constants import PROJECT_ROOT
 from config.lab_settings import LabSettings
 from lab_7_llm.main import (
@@ -13,6 +15,7 @@ from lab_7_llm.main import (
     report_time,
     TaskDataset,
     TaskEvaluator,
+    TokenizedTaskDataset,
 )
 
 
@@ -44,8 +47,11 @@ def main() -> None:
     print(sample1)          # for mark 6
 
     # for mark 8
+    tokenizer = AutoTokenizer.from_pretrained(settings.parameters.model, use_fast=True)
+    tokenized_dataset = TokenizedTaskDataset(preprocessor.data.head(100), tokenizer,
+                                             max_length=120)
     pipeline = LLMPipeline(settings.parameters.model,
-                           dataset,
+                           tokenized_dataset,
                            max_length=120,
                            batch_size=64,
                            device="cpu")
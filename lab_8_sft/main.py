@@ -4,26 +4,30 @@ Laboratory work.
 Fine-tuning Large Language Models for a downstream task.
 """
 # pylint: disable=too-few-public-methods, undefined-variable, duplicate-code, unused-argument, too-many-arguments
+import os
+import warnings
+from functools import partial
 from pathlib import Path
-from typing import Iterable, Sequence
+from typing import Any, cast, Iterable, Sequence
 
 import datasets
+import numpy as np
 import pandas as pd
 import torch
 from evaluate import load
 from pandas import DataFrame
 from peft import get_peft_model, LoraConfig
-from torch.utils.data import DataLoader, Dataset
-from torchinfo import summary
+from torch.utils.data import BatchSampler, DataLoader, Dataset
 from transformers import (
     AutoModelForSequenceClassification,
     AutoTokenizer,
+    DataCollatorWithPadding,
     Trainer,
     TrainingArguments,
 )
 
 from config.lab_settings import SFTParams
-from core_utils.llm.llm_pipeline import AbstractLLMPipeline
+from core_utils.llm.llm_pipeline import AbstractLLMPipeline, HFModelLike
 from core_utils.llm.metrics import Metrics
 from core_utils.llm.raw_data_importer import AbstractRawDataImporter
 from core_utils.llm.raw_data_preprocessor import AbstractRawDataPreprocessor, ColumnNames
@@ -31,6 +35,11 @@ from core_utils.llm.sft_pipeline import AbstractSFTPipeline
 from core_utils.llm.task_evaluator import AbstractTaskEvaluator
 from core_utils.llm.time_decorator import report_time
 
+try:
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+except ImportError:
+    ORTModelForSequenceClassification = None  # type: ignore
+
 
 class RawDataImporter(AbstractRawDataImporter):
     """
@@ -97,6 +106,10 @@ class TaskDataset(Dataset):
             data (pandas.DataFrame): Original data
         """
         self._data = data
+        self._premise = (np.empty(0, dtype=object) if data.empty
+                         else data[ColumnNames.PREMISE.value].to_numpy(dtype=object))
+        self._hypothesis = (np.empty(0, dtype=object) if data.empty
+                            else data[ColumnNames.HYPOTHESIS.value].to_numpy(dtype=object))
 
     def __len__(self) -> int:
         """
@@ -117,8 +130,7 @@ class TaskDataset(Dataset):
         Returns:
             tuple[str, ...]: The item to be received
         """
-        return (self._data.iloc[index][ColumnNames.PREMISE.value],
-                self._data.iloc[index][ColumnNames.HYPOTHESIS.value])
+        return self._premise[index], self._hypothesis[index]
 
     @property
     def data(self) -> DataFrame:
@@ -148,7 +160,7 @@ def tokenize_sample(
     """
     tokenized_input = tokenizer(sample[ColumnNames.PREMISE.value],
                                 sample[ColumnNames.HYPOTHESIS.value],
-                                padding="max_length",
+                                padding=False,
                                 truncation=True,
                                 max_length=max_length,
                                 return_tensors="pt")
@@ -173,9 +185,17 @@ class TokenizedTaskDataset(Dataset):
                 tokenize the dataset
             max_length (int): max length of a sequence
         """
-        self._data = list(data.apply(lambda sample:
-                                     tokenize_sample(sample, tokenizer, max_length),
-                                     axis=1))
+        tokens = tokenizer(list(data[ColumnNames.PREMISE.value]),
+                           list(data[ColumnNames.HYPOTHESIS.value]),
+                           padding=False,
+                           truncation=True,
+                           max_length=max_length)
+        self._data = [{"input_ids": torch.tensor(input_ids),
+                       "attention_mask": torch.tensor(attention_mask),
+                       "labels": torch.tensor(label)}
+                      for input_ids, attention_mask, label in zip(tokens["input_ids"],
+                                                                  tokens["attention_mask"],
+                                                                  data[ColumnNames.TARGET.value])]
 
     def __len__(self) -> int:
         """
@@ -199,15 +219,63 @@ class TokenizedTaskDataset(Dataset):
         return dict(self._data[index])
 
 
+def tokenize_batch(
+    sample_batch: Sequence[tuple[str, ...]], tokenizer: AutoTokenizer
+) -> dict[str, torch.Tensor]:
+    """
+    Tokenize a batch of premise and hypothesis pairs.
+
+    Used as a DataLoader collate function, so tokenization runs inside worker processes.
+
+    Args:
+        sample_batch (Sequence[tuple[str, ...]]): Samples to tokenize
+        tokenizer (transformers.models.auto.tokenization_auto.AutoTokenizer): Tokenizer to
+            tokenize the samples
+
+    Returns:
+        dict[str, torch.Tensor]: Padded tokenized batch
+    """
+    premises, hypotheses = zip(*sample_batch)
+    return dict(tokenizer(list(premises), list(hypotheses), padding=True,
+                          truncation=True, return_tensors='pt'))
+
+
+def collect_parameters(model: torch.nn.Module) -> list[torch.nn.Parameter]:
+    """
+    Collect model parameters the way torchinfo accounts for them.
+
+    Every leaf module contributes all of its parameters, so weights tied between
+    modules (e.g. input embeddings and the output projection) are listed once per module.
+
+    Args:
+        model (torch.nn.Module): Model to inspect
+
+    Returns:
+        list[torch.nn.Parameter]: Parameters of the model
+    """
+    leaf_parameters = [parameter for module in model.modules() if not any(module.children())
+                       for parameter in module.parameters()]
+    leaf_ids = {id(parameter) for parameter in leaf_parameters}
+    return leaf_parameters + [parameter for parameter in model.parameters()
+                              if id(parameter) not in leaf_ids]
+
+
 class LLMPipeline(AbstractLLMPipeline):
     """
     A class that initializes a model, analyzes its properties and infers it.
     """
 
-    _model: torch.nn.Module
+    _model: torch.nn.Module | HFModelLike
 
     def __init__(
-        self, model_name: str, dataset: TaskDataset, max_length: int, batch_size: int, device: str
+        self,
+        model_name: str,
+        dataset: TaskDataset,
+        max_length: int,
+        batch_size: int,
+        device: str,
+        *,
+        quantize: bool = False
     ) -> None:
         """
         Initialize an instance of LLMPipeline.
@@ -218,9 +286,35 @@ class LLMPipeline(AbstractLLMPipeline):
             max_length (int): The maximum length of generated sequence.
             batch_size (int): The size of the batch inside DataLoader.
             device (str): The device for inference.
+            quantize (bool): Whether to apply INT8 dynamic quantization to linear layers
+                when inferring on CPU.
         """
         super().__init__(model_name, dataset, max_length, batch_size, device)
-        self._model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self._tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        use_ort = os.environ.get("USE_ORT") == "1"
+        if use_ort and ORTModelForSequenceClassification is None:
+            warnings.warn('Library "optimum" not installed, falling back to PyTorch inference.',
+                          stacklevel=2)
+            use_ort = False
+
+        if use_ort:
+            self._model = ORTModelForSequenceClassification.from_pretrained(
+                model_name,
+                export=True,
+                provider="CUDAExecutionProvider" if device == "cuda" else "CPUExecutionProvider"
+            )
+        else:
+            model: torch.nn.Module = AutoModelForSequenceClassification.from_pretrained(
+                model_name, torch_dtype=torch.float16 if device == "cuda" else torch.float32
+            ).to(device)
+            model.eval()
+            if quantize and device == "cpu":
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            self._model = model
+            if device == "cuda":
+                self._compile_model()
 
     def analyze_model(self) -> dict:
         """
@@ -229,18 +323,20 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             dict: Properties of a model
         """
-        tensor_data = torch.ones(1, self._model.config.max_position_embeddings, dtype=torch.long)
-        input_data = {'attention_mask': tensor_data,
-                      "input_ids": tensor_data}
-        analytics = summary(self._model, input_data=input_data, verbose=False)
+        if not isinstance(self._model, torch.nn.Module):
+            raise ValueError("Incorrect type of model")
+
+        embeddings_length = self._model.config.max_position_embeddings
+        parameters = collect_parameters(self._model)
         return {
-            "embedding_size": self._model.config.max_position_embeddings,
-            "input_shape": {'attention_mask': list(analytics.input_size['attention_mask']),
-                            'input_ids': list(analytics.input_size['input_ids'])},
+            "embedding_size": embeddings_length,
+            "input_shape": {'attention_mask': [1, embeddings_length],
+                            'input_ids': [1, embeddings_length]},
             "max_context_length": self._model.config.max_length,
-            "num_trainable_params": analytics.trainable_params,
-            "output_shape": analytics.summary_list[-1].output_size,
-            "size": analytics.total_param_bytes,
+            "num_trainable_params": sum(parameter.numel() for parameter in parameters
+                                        if parameter.requires_grad),
+            "output_shape": [1, self._model.config.num_labels],
+            "size": sum(parameter.numel() * parameter.element_size() for parameter in parameters),
             "vocab_size": self._model.config.vocab_size
         }
 
@@ -255,9 +351,9 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             str | None: A prediction
         """
-        if not self._model:
+        if self._model is None:
             return None
-        return self._infer_batch((sample,))[0]
+        return self._infer_batch(tokenize_batch((sample,), self._tokenizer))[0]
 
     @report_time
     def infer_dataset(self) -> pd.DataFrame:
@@ -267,36 +363,69 @@ class LLMPipeline(AbstractLLMPipeline):
         Returns:
             pd.DataFrame: Data with predictions
         """
-        loader = DataLoader(self._dataset, self._batch_size)
-        predictions = []
+        lengths = (self._dataset.data[ColumnNames.PREMISE.value].str.len() +
+                   self._dataset.data[ColumnNames.HYPOTHESIS.value].str.len()).to_numpy()
+        order = lengths.argsort(kind="stable")
+        num_workers = (os.cpu_count() or 1) // 2
+        if num_workers:
+            os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        loader = DataLoader(self._dataset,
+                            batch_sampler=BatchSampler(order.tolist(), self._batch_size,
+                                                       drop_last=False),
+                            collate_fn=partial(tokenize_batch, tokenizer=self._tokenizer),
+                            num_workers=num_workers,
+                            pin_memory=self._device == "cuda",
+                            prefetch_factor=4 if num_workers else None,
+                            persistent_workers=num_workers > 0)
+        predictions: list[str | None] = [None] * len(order)
+        offset = 0
         for batch in loader:
-            predictions.extend(self._infer_batch(batch))
+            batch_predictions = self._infer_batch(batch)
+            predictions[offset:offset + len(batch_predictions)] = batch_predictions
+            offset += len(batch_predictions)
         res = pd.DataFrame(self._dataset.data)
-        res[ColumnNames.PREDICTION.value] = predictions
+        res[ColumnNames.PREDICTION.value] = [predictions[position] for position in order.argsort()]
         return res[[ColumnNames.TARGET.value, ColumnNames.PREDICTION.value]]
 
-    @torch.no_grad()
-    def _infer_batch(self, sample_batch: Sequence[tuple[str, ...]]) -> list[str]:
+    @torch.inference_mode()
+    def _infer_batch(self, sample_batch: dict[str, torch.Tensor]) -> list[str]:
         """
         Infer single batch.
 
         Args:
-            sample_batch (Sequence[tuple[str, ...]]): batch to infer the model
+            sample_batch (dict[str, torch.Tensor]): tokenized batch to infer the model
 
         Returns:
             list[str]: model predictions as strings
         """
-        if self._model:
-            tokenizer = AutoTokenizer.from_pretrained(self._model_name)
-            if len(sample_batch) == 1:
-                tokens = tokenizer(sample_batch[0][0], sample_batch[0][1], padding=True,
-                                   truncation=True, return_tensors='pt')
-            else:
-                tokens = tokenizer(sample_batch[0], sample_batch[1], padding=True,
-                                   truncation=True, return_tensors='pt')
-
-            output = self._model(**tokens).logits
-        return [str(prediction.item()) for prediction in list(torch.argmax(output, dim=1))]
+        if self._model is not None:
+            tokens: dict[str, Any] = {name: tensor.to(self._device, non_blocking=True)
+                                      for name, tensor in sample_batch.items()}
+            with torch.autocast(device_type=self._device, dtype=torch.float16,
+                                enabled=self._device == "cuda"):
+                output = self._model(**tokens).logits
+        return [str(prediction) for prediction in torch.argmax(output, dim=1).tolist()]
+
+    def _compile_model(self) -> None:
+        """
+        Compile the model with torch.compile, keeping the eager model if compilation fails.
+
+        torch.compile is lazy, so a warm-up forward pass is run to trigger the compilation.
+        """
+        compiled_model = cast(torch.nn.Module,
+                              torch.compile(self._model, mode="reduce-overhead", dynamic=True))
+        warm_up_batch = tokenize_batch((("warm-up", "warm-up"),) * 2, self._tokenizer)
+        try:
+            with torch.inference_mode(), torch.autocast(device_type=self._device,
+                                                        dtype=torch.float16,
+                                                        enabled=self._device == "cuda"):
+                compiled_model(**{name: tensor.to(self._device)
+                                  for name, tensor in warm_up_batch.items()})
+        except RuntimeError:
+            warnings.warn("Failed to compile the model, falling back to eager mode.",
+                          stacklevel=2)
+            return
+        self._model = compiled_model
 
 
 class TaskEvaluator(AbstractTaskEvaluator):
@@ -349,6 +478,7 @@ class SFTPipeline(AbstractSFTPipeline):
         super().__init__(model_name, dataset)
 
         self._model = AutoModelForSequenceClassification.from_pretrained(self._model_name)
+        self._tokenizer = AutoTokenizer.from_pretrained(self._model_name, use_fast=True)
         self._batch_size = sft_params.batch_size
         self._max_length = sft_params.max_length
         self._max_sft_steps = sft_params.max_fine_tuning_steps
@@ -379,7 +509,8 @@ class SFTPipeline(AbstractSFTPipeline):
 
         trainer = Trainer(model=model,
                           args=training_args,
-                          train_dataset=self._dataset)
+                          train_dataset=self._dataset,
+                          data_collator=DataCollatorWithPadding(self._tokenizer))
 
         trainer.train()
 
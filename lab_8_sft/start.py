@@ -50,7 +50,7 @@ def main() -> None:
     sft_params = SFTParams(batch_size=3, max_length=120, max_fine_tuning_steps=50, device="cpu",
                            learning_rate=1e-2,
                            finetuned_model_path=predictions_path / settings.parameters.model)
-    tokenizer = AutoTokenizer.from_pretrained(settings.parameters.model)
+    tokenizer = AutoTokenizer.from_pretrained(settings.parameters.model, use_fast=True)
     tokenizer.save_pretrained(sft_params.finetuned_model_path)
 
     num_samples = 10